@@ -7,10 +7,13 @@
 import torch
 
 from segment_anything import sam_model_registry
+from segment_anything.modeling.common import LayerNorm2dGELU
 from segment_anything.utils.onnx import SamOnnxModel
 
 import argparse
+import os
 import warnings
+from typing import List, Optional
 
 try:
     import onnxruntime  # type: ignore
@@ -55,6 +58,19 @@ parser.add_argument(
     help="The ONNX opset version to use. Must be >=11",
 )
 
+parser.add_argument(
+    "--num-points",
+    type=int,
+    nargs="+",
+    default=None,
+    help=(
+        "If set, exports one model per given number of points with a static "
+        "point dimension instead of a single model with a dynamic one, e.g. "
+        "for building fixed-shape TensorRT engines with trtexec. Each model is "
+        "saved with a '_<n>points' suffix added to the output filename."
+    ),
+)
+
 parser.add_argument(
     "--quantize-out",
     type=str,
@@ -103,6 +119,7 @@ def run_export(
     gelu_approximate: bool = False,
     use_stability_score: bool = False,
     return_extra_metrics=False,
+    num_points: Optional[List[int]] = None,
 ):
     print("Loading model...")
     sam = sam_model_registry[model_type](checkpoint=checkpoint)
@@ -116,21 +133,34 @@ def run_export(
 
     if gelu_approximate:
         for n, m in onnx_model.named_modules():
-            if isinstance(m, torch.nn.GELU):
+            if isinstance(m, (torch.nn.GELU, LayerNorm2dGELU)):
                 m.approximate = "tanh"
 
-    dynamic_axes = {
-        "point_coords": {1: "num_points"},
-        "point_labels": {1: "num_points"},
-    }
+    if num_points is None:
+        dynamic_axes = {
+            "point_coords": {1: "num_points"},
+            "point_labels": {1: "num_points"},
+        }
+        export_onnx(onnx_model, output, opset, 5, dynamic_axes)
+    else:
+        for n in num_points:
+            export_onnx(onnx_model, with_num_points_suffix(output, n), opset, n, None)
 
-    embed_dim = sam.prompt_encoder.embed_dim
-    embed_size = sam.prompt_encoder.image_embedding_size
+
+def export_onnx(
+    onnx_model: SamOnnxModel,
+    output: str,
+    opset: int,
+    num_points: int,
+    dynamic_axes: Optional[dict],
+):
+    embed_dim = onnx_model.model.prompt_encoder.embed_dim
+    embed_size = onnx_model.model.prompt_encoder.image_embedding_size
     mask_input_size = [4 * x for x in embed_size]
     dummy_inputs = {
         "image_embeddings": torch.randn(1, embed_dim, *embed_size, dtype=torch.float),
-        "point_coords": torch.randint(low=0, high=1024, size=(1, 5, 2), dtype=torch.float),
-        "point_labels": torch.randint(low=0, high=4, size=(1, 5), dtype=torch.float),
+        "point_coords": torch.randint(low=0, high=1024, size=(1, num_points, 2), dtype=torch.float),
+        "point_labels": torch.randint(low=0, high=4, size=(1, num_points), dtype=torch.float),
         "mask_input": torch.randn(1, 1, *mask_input_size, dtype=torch.float),
         "has_mask_input": torch.tensor([1], dtype=torch.float),
         "orig_im_size": torch.tensor([1500, 2250], dtype=torch.float),
@@ -171,6 +201,11 @@ def to_numpy(tensor):
     return tensor.cpu().numpy()
 
 
+def with_num_points_suffix(path: str, num_points: int) -> str:
+    root, ext = os.path.splitext(path)
+    return f"{root}_{num_points}points{ext}"
+
+
 if __name__ == "__main__":
     args = parser.parse_args()
     run_export(
@@ -182,6 +217,7 @@ if __name__ == "__main__":
         gelu_approximate=args.gelu_approximate,
         use_stability_score=args.use_stability_score,
         return_extra_metrics=args.return_extra_metrics,
+        num_points=args.num_points,
     )
 
     if args.quantize_out is not None:
@@ -189,13 +225,24 @@ if __name__ == "__main__":
         from onnxruntime.quantization import QuantType  # type: ignore
         from onnxruntime.quantization.quantize import quantize_dynamic  # type: ignore
 
-        print(f"Quantizing model and writing to {args.quantize_out}...")
-        quantize_dynamic(
-            model_input=args.output,
-            model_output=args.quantize_out,
-            optimize_model=True,
-            per_channel=False,
-            reduce_range=False,
-            weight_type=QuantType.QUInt8,
-        )
+        if args.num_points is None:
+            to_quantize = [(args.output, args.quantize_out)]
+        else:
+            to_quantize = [
+                (
+                    with_num_points_suffix(args.output, n),
+                    with_num_points_suffix(args.quantize_out, n),
+                )
+                for n in args.num_points
+            ]
+        for model_input, model_output in to_quantize:
+            print(f"Quantizing model and writing to {model_output}...")
+            quantize_dynamic(
+                model_input=model_input,
+                model_output=model_output,
+                optimize_model=True,
+                per_channel=False,
+                reduce_range=False,
+                weight_type=QuantType.QUInt8,
+            )
         print("Done!")
@@ -6,9 +6,12 @@
 
 import torch
 import torch.nn as nn
+from torch.nn import functional as F
 
 from typing import Type
 
+from .fused_layer_norm import layer_norm_2d_gelu, triton_exists
+
 
 class MLPBlock(nn.Module):
     def __init__(
@@ -33,11 +36,42 @@ class LayerNorm2d(nn.Module):
         super().__init__()
         self.weight = nn.Parameter(torch.ones(num_channels))
         self.bias = nn.Parameter(torch.zeros(num_channels))
+        self.normalized_shape = (num_channels,)
         self.eps = eps
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if x.is_contiguous(memory_format=torch.channels_last):
+            # Channels are innermost in memory, so normalize them directly
+            x = F.layer_norm(
+                x.permute(0, 2, 3, 1), self.normalized_shape, self.weight, self.bias, self.eps
+            )
+            return x.permute(0, 3, 1, 2)
         u = x.mean(1, keepdim=True)
         s = (x - u).pow(2).mean(1, keepdim=True)
         x = (x - u) / torch.sqrt(s + self.eps)
         x = self.weight[:, None, None] * x + self.bias[:, None, None]
         return x
+
+
+class LayerNorm2dGELU(LayerNorm2d):
+    """
+    LayerNorm2d followed by GELU. Without autograd, channels_last CUDA inputs
+    run both in one Triton kernel that reads and writes the tensor once;
+    other inputs fall back to LayerNorm2d and F.gelu.
+    """
+
+    def __init__(self, num_channels: int, eps: float = 1e-6) -> None:
+        super().__init__(num_channels, eps)
+        self.approximate = "none"
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if (
+            triton_exists
+            and self.approximate == "none"
+            and x.is_cuda
+            and x.is_contiguous(memory_format=torch.channels_last)
+            and not (torch.is_grad_enabled() and (x.requires_grad or self.weight.requires_grad))
+            and not torch.jit.is_tracing()
+        ):
+            return layer_norm_2d_gelu(x, self.weight, self.bias, self.eps)
+        return F.gelu(super().forward(x), approximate=self.approximate)
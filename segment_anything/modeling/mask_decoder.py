@@ -4,13 +4,15 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+import functools
+
 import torch
 from torch import nn
 from torch.nn import functional as F
 
-from typing import List, Tuple, Type
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type
 
-from .common import LayerNorm2d
+from .common import LayerNorm2d, LayerNorm2dGELU
 
 # 这个MaskDecoder类实现了基于transformer的掩码解码器。
 class MaskDecoder(nn.Module):
@@ -22,11 +24,16 @@ class MaskDecoder(nn.Module):
     #     - activation: 上采样掩码时使用的激活函数类型
     #     - iou_head_depth: 用于预测掩码质量的 MLP 的深度
     #     - iou_head_hidden_dim: 用于预测掩码质量的 MLP 的隐藏维度
+    #     - mask_matmul_dtype: 可选, 在 CUDA 上以该低精度类型 autocast 上采样和最终的掩码矩阵乘法,
+    #       默认为 None, 保持输入精度
+    #     - deduplicate_prompts: 是否只对 batch 中不同的 prompt 进行解码, 默认为 False
     # 2. 记录 transformer_dim 和 transformer。
     # 3. 记录 num_multimask_outputs。
-    # 4. 嵌入 iou_token 和 mask_tokens。
-    # 5. 定义 output_upscaling 为上采样器,用于上采样 transformer 的输出以得到掩码。
-    # 6. 定义 output_hypernetworks_mlps 为 MLP 列表,个数为 num_mask_tokens, 用于从 transformer 的输出生成掩码通道。
+    # 4. 嵌入 output_tokens, 第一个为 iou token, 其余 num_mask_tokens 个为 mask tokens。
+    # 5. 定义 output_upscaling 为上采样器,用于上采样 transformer 的输出以得到掩码, 使用 channels_last 内存格式。
+    #    激活函数为 GELU 时, 使用融合的 LayerNorm2dGELU 代替 LayerNorm2d 和 GELU。
+    # 6. 定义 output_hypernetworks_mlps 为 _FusedHyperMLP, 将 num_mask_tokens 个 MLP 的权重堆叠并预先转置,
+    #    用于从 transformer 的输出生成掩码通道。
     # 7. 定义 iou_prediction_head 为 MLP,用于从 transformer 的输出预测掩码的 IOU。
     def __init__(
         self,
@@ -37,6 +44,8 @@ class MaskDecoder(nn.Module):
         activation: Type[nn.Module] = nn.GELU,
         iou_head_depth: int = 3,
         iou_head_hidden_dim: int = 256,
+        mask_matmul_dtype: Optional[torch.dtype] = None,
+        deduplicate_prompts: bool = False,
     ) -> None:
         """
         Predicts masks given an image and prompt embeddings, using a
@@ -53,6 +62,14 @@ class MaskDecoder(nn.Module):
             mask quality
           iou_head_hidden_dim (int): the hidden dimension of the MLP
             used to predict mask quality
+          mask_matmul_dtype (torch.dtype or None): if given, the upscaling
+            and the final matmul producing the mask logits are autocast to
+            this reduced precision dtype for float32 inputs on CUDA. The
+            default None keeps the input precision.
+          deduplicate_prompts (bool): if True, repeated prompts in a batch
+            on a single image are decoded only once. Finding them syncs with
+            the host on every call, so this is only worth enabling when
+            duplicates are expected.
         """
         super().__init__()
         self.transformer_dim = transformer_dim
@@ -60,18 +77,27 @@ class MaskDecoder(nn.Module):
 
         self.num_multimask_outputs = num_multimask_outputs
 
-        self.iou_token = nn.Embedding(1, transformer_dim)
+        # The iou token followed by the mask tokens, kept in one table so the
+        # output tokens don't have to be concatenated on every forward.
         self.num_mask_tokens = num_multimask_outputs + 1
-        self.mask_tokens = nn.Embedding(self.num_mask_tokens, transformer_dim)
+        self.output_tokens = nn.Embedding(1 + self.num_mask_tokens, transformer_dim)
 
+        if activation is nn.GELU:
+            # Fused into one kernel; the Identity keeps the checkpoint layer indices
+            norm_and_activation = [LayerNorm2dGELU(transformer_dim // 4), nn.Identity()]
+        else:
+            norm_and_activation = [LayerNorm2d(transformer_dim // 4), activation()]
         self.output_upscaling = nn.Sequential(
             nn.ConvTranspose2d(transformer_dim, transformer_dim // 4, kernel_size=2, stride=2),
-            LayerNorm2d(transformer_dim // 4),
-            activation(),
+            *norm_and_activation,
             nn.ConvTranspose2d(transformer_dim // 4, transformer_dim // 8, kernel_size=2, stride=2),
+            # Not a no-op for the trained weights (it suppresses the negative features
+            # feeding the mask matmul), so it is kept; see compile_predict_masks
             activation(),
         )
-        self.output_hypernetworks_mlps = nn.ModuleList(
+        # Run the upscaler in NHWC so LayerNorm2d normalizes channels without a permute copy
+        self.output_upscaling = self.output_upscaling.to(memory_format=torch.channels_last)
+        self.output_hypernetworks_mlps = _FusedHyperMLP(
             [
                 MLP(transformer_dim, transformer_dim, transformer_dim // 8, 3)
                 for i in range(self.num_mask_tokens)
@@ -79,9 +105,65 @@ class MaskDecoder(nn.Module):
         )
 
         self.iou_prediction_head = MLP(
-            transformer_dim, iou_head_hidden_dim, self.num_mask_tokens, iou_head_depth
+            transformer_dim,
+            iou_head_hidden_dim,
+            self.num_mask_tokens,
+            iou_head_depth,
+            pretransposed=True,
         )
 
+        self.mask_matmul_dtype = mask_matmul_dtype
+        self.deduplicate_prompts = deduplicate_prompts
+        self.predict_masks_compile_mode: Optional[str] = None
+        # Compiled predict_masks for each torch.compile mode, see _get_compiled_predict_masks
+        self._compiled_predict_masks: Dict[str, Callable] = {}
+
+    # compile_predict_masks 方法: 使用 torch.compile 编译 predict_masks, 融合算子并减少 kernel 启动开销。
+    def compile_predict_masks(self, mode: str = "reduce-overhead") -> None:
+        """
+        Compiles predict_masks with torch.compile. The default mode captures
+        the decoder in CUDA graphs, recording one graph per distinct number of
+        prompts and mask slice and replaying it on later calls. Shapes are
+        compiled as dynamic since the number of prompts varies between calls;
+        the multimask_output branch stays in forward, outside the compiled
+        region. With mode="max-autotune", inductor may also generate the
+        upscaler's transposed convolutions itself and apply the trailing
+        activation in their epilogue.
+
+        Arguments:
+          mode (str): the torch.compile mode to use
+        """
+        if not hasattr(torch, "compile"):
+            raise RuntimeError("Compiling the mask decoder requires torch.compile.")
+        self.predict_masks_compile_mode = mode
+
+    # _get_compiled_predict_masks 方法: 返回以 mode 编译的 predict_masks, 第一次调用时才编译。
+    # 编译的是未绑定的 predict_masks, 调用时显式传入 self, 所以复制的 decoder 使用自己的权重。
+    # 每个 decoder 实例有自己的编译结果和 CUDA graph, 只有 DataParallel 的副本与原模块共享。
+    def _get_compiled_predict_masks(self, mode: str) -> Callable:
+        if mode not in self._compiled_predict_masks:
+            self._compiled_predict_masks[mode] = torch.compile(
+                type(self).predict_masks, mode=mode, fullgraph=False, dynamic=True
+            )
+        return self._compiled_predict_masks[mode]
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = super().__getstate__()
+        # The compiled functions can't be pickled, and a copy must not replay CUDA
+        # graphs captured for this module; copies compile their own on first use
+        state["_compiled_predict_masks"] = {}
+        return state
+
+    def _replicate_for_data_parallel(self) -> "MaskDecoder":
+        replica = super()._replicate_for_data_parallel()
+        # Replicas get new parameter copies on every forward, so CUDA graphs
+        # captured for them could never be replayed. They share the compiled
+        # functions of this module (replicas are rebuilt on every forward and
+        # would otherwise recompile each time), using a mode without CUDA graphs.
+        mode = replica.predict_masks_compile_mode
+        replica.predict_masks_compile_mode = _NO_CUDAGRAPHS_MODE.get(mode, mode)
+        return replica
+
     # 这个 forward 方法的作用是根据图像和 prompt 的 embedding 预测掩码。它包含:
     # 1. 输入参数:
     #     - image_embeddings: 图像编码器的输出
@@ -89,10 +171,14 @@ class MaskDecoder(nn.Module):
     #     - sparse_prompt_embeddings: 点和框的 embedding
     #     - dense_prompt_embeddings: 掩码输入的 embedding
     #     - multimask_output: 是否返回多个掩码或单个掩码
-    # 2. 调用 predict_masks 根据图像和 prompt 的 embedding 预测掩码 masks 和掩码质量 iou_pred。
-    # 3. 如果 multimask_output 为 True,则选择 masks 的第 1 个维度后的全部切片。否则选择第一个切片。
-    # 4. 相应地选择 iou_pred 的切片。
-    # 5. 准备输出,返回 masks 和 iou_pred。
+    #     - output_size: 可选, 将掩码双线性插值到的大小 (H, W)
+    # 2. 如果 multimask_output 为 True,则选择 mask token 的第 1 个之后的全部切片。否则选择第一个切片。
+    # 3. 通过 _run_predict_masks 调用 predict_masks 根据图像和 prompt 的 embedding 预测掩码 masks 和掩码质量 iou_pred。
+    # 4. predict_masks 只计算 mask_slice 选中的掩码, 不再计算随后会被丢弃的掩码。
+    # 5. 如果提供了 output_size, 只对选中的掩码进行插值。
+    #    如果 predict_masks 使用 CUDA graph 编译, 复制输出以免被下一次 replay 覆盖,
+    #    插值后的 masks 已经是新的张量, 不需要复制。
+    # 6. 准备输出,返回 masks 和 iou_pred。
     # 所以,这个 forward 方法实现了根据图像和 prompt 的 embedding 预测掩码的功能。
     # 它可以根据输入的 prompt 学习掩码生成的高度非线性映射,为 prompt 驱动生成模型提供掩码预测的关键能力。
     # 这个 forward 方法提供了根据 prompt 预测掩码的具体实现。它发挥了 MaskDecoder 类的强大功能,
@@ -104,6 +190,7 @@ class MaskDecoder(nn.Module):
         sparse_prompt_embeddings: torch.Tensor,
         dense_prompt_embeddings: torch.Tensor,
         multimask_output: bool,
+        output_size: Optional[Tuple[int, int]] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """
         Predict masks given image and prompt embeddings.
@@ -115,45 +202,104 @@ class MaskDecoder(nn.Module):
           dense_prompt_embeddings (torch.Tensor): the embeddings of the mask inputs
           multimask_output (bool): Whether to return multiple masks or a single
             mask.
+          output_size (tuple(int, int) or None): If given, the masks are
+            bilinearly upsampled to this size in (H, W) format.
 
         Returns:
           torch.Tensor: batched predicted masks
           torch.Tensor: batched predictions of mask quality
         """
-        masks, iou_pred = self.predict_masks(
+        # Select the correct mask or masks for output
+        if multimask_output:
+            mask_slice = slice(1, None)
+        else:
+            mask_slice = slice(0, 1)
+
+        masks, iou_pred = self._run_predict_masks(
             image_embeddings=image_embeddings,
             image_pe=image_pe,
             sparse_prompt_embeddings=sparse_prompt_embeddings,
             dense_prompt_embeddings=dense_prompt_embeddings,
+            mask_slice=mask_slice,
+            # Interpolated masks are already a fresh tensor
+            clone_masks=output_size is None,
         )
 
-        # Select the correct mask or masks for output
-        if multimask_output:
-            mask_slice = slice(1, None)
-        else:
-            mask_slice = slice(0, 1)
-        masks = masks[:, mask_slice, :, :]
-        iou_pred = iou_pred[:, mask_slice]
+        # Only the selected masks are upsampled
+        if output_size is not None:
+            masks = F.interpolate(masks, size=output_size, mode="bilinear", align_corners=False)
 
         # Prepare output
         return masks, iou_pred
 
+    # _run_predict_masks 方法: 调用 predict_masks (编译后调用这个实例自己的编译结果), 并处理编译后需要的准备和收尾工作:
+    # 标记 image_embeddings 的 batch 维度为静态, 开始新的 CUDA graph step,
+    # 并在使用 CUDA graph 时复制输出以免被下一次 replay 覆盖 (clone_masks 为 False 时只复制 iou_pred)。
+    # forward 和 predict_masks_batched 都通过这个方法调用 predict_masks。
+    def _run_predict_masks(
+        self,
+        image_embeddings: torch.Tensor,
+        image_pe: torch.Tensor,
+        sparse_prompt_embeddings: torch.Tensor,
+        dense_prompt_embeddings: torch.Tensor,
+        mask_slice: slice,
+        sparse_prompt_padding_mask: Optional[torch.Tensor] = None,
+        clone_masks: bool = True,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        mode = self.predict_masks_compile_mode
+        uses_cudagraphs = mode in _NO_CUDAGRAPHS_MODE
+        if mode is not None:
+            # Only the number of prompts should be dynamic
+            torch._dynamo.mark_static(image_embeddings, 0)
+            predict_masks = functools.partial(self._get_compiled_predict_masks(mode), self)
+        else:
+            predict_masks = self.predict_masks
+        if uses_cudagraphs:
+            # Each call is a new step, so this instance's graphs may overwrite earlier outputs
+            torch.compiler.cudagraph_mark_step_begin()
+
+        masks, iou_pred = predict_masks(
+            image_embeddings=image_embeddings,
+            image_pe=image_pe,
+            sparse_prompt_embeddings=sparse_prompt_embeddings,
+            dense_prompt_embeddings=dense_prompt_embeddings,
+            mask_slice=mask_slice,
+            sparse_prompt_padding_mask=sparse_prompt_padding_mask,
+        )
+
+        if uses_cudagraphs and masks.is_cuda:
+            # Outputs of a replayed CUDA graph live in its static buffers and
+            # are overwritten by the next replay, so hand out copies
+            if clone_masks:
+                masks = masks.clone()
+            iou_pred = iou_pred.clone()
+
+        return masks, iou_pred
+
     # 这个 predict_masks 方法的作用是预测掩码。它包含:
     # 1. 输入参数:
     #     - image_embeddings: 图像编码器的输出
     #     - image_pe: 与 image_embeddings 形状相同的位置编码
     #     - sparse_prompt_embeddings: 点和框的 embedding
     #     - dense_prompt_embeddings: 掩码输入的 embedding
-    # 2. 拼接 iou_token 和 mask_tokens 作为输出 tokens, 扩展至 batch 大小, 与 sparse_prompt_embeddings 拼接作为 tokens。
-    # 3. 通过 torch.repeat_interleave 扩展 src 和 pos_src 至与 tokens 相同的 batch 大小。
-    # 4. 将 src 和 pos_src 以及 tokens 输入 transformer, 获得 hs 和 src。
-    # 5. 获得 iou_token_out 和 mask_tokens_out 作为 transformer 的输出。
+    #     - mask_slice: 要预测的 mask token 的切片, 为 None 时预测全部掩码
+    #     - sparse_prompt_padding_mask: 可选, 为 True 的 sparse prompt embedding 是填充的, 会被忽略
+    # 2. 如果 deduplicate_prompts 为 True 且 batch 中有重复的 prompt, 只对不同的 prompt 进行解码。
+    #    将 output_tokens (iou token 和 mask tokens) 扩展至 batch 大小,
+    #    与 sparse_prompt_embeddings 拼接作为 tokens。
+    # 3. 扩展 src 和 pos_src 至与 tokens 相同的 batch 大小:
+    #    batch 为 1 时使用 expand (不复制数据), 否则使用 torch.repeat_interleave。
+    # 4. 将 src 和 pos_src 以及 tokens 输入 transformer, 获得 hs 和形状为 b x c x h x w 的 src。
+    # 5. 获得 iou_token_out 和 mask_tokens_out 作为 transformer 的输出,
+    #    mask_tokens_out 只保留 mask_slice 选中的 token。
     # 6. 上采样 src 得到 upscaled_embedding。
-    # 7. 对 mask_tokens_out 中的每个 token, 使用对应 MLP 得到 hyper_in_list 中的 tensor。
-    # 8. 使用 torch.stack 将 hyper_in_list 拼接为 hyper_in。
-    # 9. 计算 masks=(hyper_in @ upscaled_embedding.view(b, c, h * w)), 形状为 (b, num_mask_tokens, h, w)。
-    # 10. 使用 iou_prediction_head 从 iou_token_out 预测 iou_pred。
-    # 11. 返回 masks 和 iou_pred。
+    # 7. 使用 output_hypernetworks_mlps 以批量矩阵乘法对 mask_tokens_out 中的每个 token 同时计算对应 MLP,
+    #    得到 hyper_in。
+    # 8. 计算 masks=(hyper_in @ upscaled_embedding.flatten(2)), 形状为 (b, num_mask_tokens, h, w)。
+    #    upscaled_embedding 为 NCHW 或 channels_last 时 flatten 都不复制数据。
+    #    如果设置了 mask_matmul_dtype, 在 CUDA 上以该类型 autocast 步骤 6 和 8, 结果转换回原来的类型。
+    # 9. 使用 iou_prediction_head 从 iou_token_out 预测 iou_pred。
+    # 10. 将去重后的 masks 和 iou_pred 按 inverse 索引恢复为每个 prompt 的结果, 返回 masks 和 iou_pred。
     # 所以,这个 predict_masks 方法实现了根据prompt预测掩码的功能。
     # 它发挥 transformer 和上采样器的功能,可以从 prompt 学习生成模型的参数
     # 这个 predict_masks 方法提供了根据 prompt 预测掩码的具体实现。
@@ -165,39 +311,209 @@ class MaskDecoder(nn.Module):
         image_pe: torch.Tensor, # Bx(embed_dim=256 in vit-h)x(embed_H)x(embed_W)
         sparse_prompt_embeddings: torch.Tensor, # BxNx(embed_dim)
         dense_prompt_embeddings: torch.Tensor, # Bx(embed_dim)x(embed_H)x(embed_W)
+        mask_slice: Optional[slice] = None,
+        sparse_prompt_padding_mask: Optional[torch.Tensor] = None, # BxN
     ) -> Tuple[torch.Tensor, torch.Tensor]:
-        """Predicts masks. See 'forward' for more details."""
+        """
+        Predicts masks. See 'forward' for more details. Only the mask tokens
+        selected by mask_slice are decoded; all of them if it is None.
+        Sparse prompt embeddings marked as True in sparse_prompt_padding_mask
+        are padding and are ignored.
+        """
+        if mask_slice is None:
+            mask_slice = slice(0, None)
+
+        # Decode each distinct prompt once
+        inverse = None
+        if self.deduplicate_prompts and sparse_prompt_padding_mask is None:
+            deduplicated = self._deduplicate_prompts(
+                image_embeddings, sparse_prompt_embeddings, dense_prompt_embeddings
+            )
+            if deduplicated is not None:
+                sparse_prompt_embeddings, dense_prompt_embeddings, inverse = deduplicated
+
         # Concatenate output tokens
-        output_tokens = torch.cat([self.iou_token.weight, self.mask_tokens.weight], dim=0)
-        output_tokens = output_tokens.unsqueeze(0).expand(sparse_prompt_embeddings.size(0), -1, -1)
+        output_tokens = self.output_tokens.weight.unsqueeze(0).expand(
+            sparse_prompt_embeddings.size(0), -1, -1
+        )
         tokens = torch.cat((output_tokens, sparse_prompt_embeddings), dim=1)
+        padding_mask = None
+        if sparse_prompt_padding_mask is not None:
+            padding_mask = F.pad(sparse_prompt_padding_mask, (output_tokens.shape[1], 0))
 
-        # Expand per-image data in batch direction to be per-mask
-        src = torch.repeat_interleave(image_embeddings, tokens.shape[0], dim=0)
+        # Expand per-image data in batch direction to be per-mask. A single
+        # image is broadcast as a view rather than copied once per mask.
+        if image_embeddings.shape[0] == 1:
+            src = image_embeddings.expand(tokens.shape[0], -1, -1, -1)
+        else:
+            src = torch.repeat_interleave(image_embeddings, tokens.shape[0], dim=0)
         src = src + dense_prompt_embeddings
-        pos_src = torch.repeat_interleave(image_pe, tokens.shape[0], dim=0)
-        b, c, h, w = src.shape
+        if image_pe.shape[0] == 1:
+            pos_src = image_pe.expand(tokens.shape[0], -1, -1, -1)
+        else:
+            pos_src = torch.repeat_interleave(image_pe, tokens.shape[0], dim=0)
 
         # Run the transformer
-        hs, src = self.transformer(src, pos_src, tokens)
+        hs, src = self.transformer(
+            src, pos_src, tokens, return_spatial=True, point_padding_mask=padding_mask
+        )
         iou_token_out = hs[:, 0, :]
-        mask_tokens_out = hs[:, 1 : (1 + self.num_mask_tokens), :]
+        mask_tokens_out = hs[:, 1 : (1 + self.num_mask_tokens), :][:, mask_slice, :]
 
         # Upscale mask embeddings and predict masks using the mask tokens
-        src = src.transpose(1, 2).view(b, c, h, w)
-        upscaled_embedding = self.output_upscaling(src)
-        hyper_in_list: List[torch.Tensor] = []
-        for i in range(self.num_mask_tokens):
-            hyper_in_list.append(self.output_hypernetworks_mlps[i](mask_tokens_out[:, i, :]))
-        hyper_in = torch.stack(hyper_in_list, dim=1)
-        b, c, h, w = upscaled_embedding.shape
-        masks = (hyper_in @ upscaled_embedding.view(b, c, h * w)).view(b, -1, h, w)
+        # The transformer returns src as a channels_last view, so this does not copy
+        src = src.contiguous(memory_format=torch.channels_last)
+        hyper_in = self.output_hypernetworks_mlps(mask_tokens_out, mask_slice)
+        use_autocast = (
+            self.mask_matmul_dtype is not None and src.is_cuda and src.dtype == torch.float32
+        )
+        # Under autocast the transposed convolutions write the reduced
+        # precision embedding directly, so the matmul reading it does not
+        # need a separate cast
+        with torch.autocast("cuda", dtype=self.mask_matmul_dtype, enabled=use_autocast):
+            upscaled_embedding = self.output_upscaling(src)
+            b, c, h, w = upscaled_embedding.shape
+            # A view for both NCHW and channels_last outputs; the matmul reads the
+            # channels_last case as a transposed operand, so neither is copied
+            upscaled_embedding = upscaled_embedding.flatten(2)
+            masks = hyper_in @ upscaled_embedding
+        masks = masks.to(src.dtype).view(b, -1, h, w)
 
         # Generate mask quality predictions
-        iou_pred = self.iou_prediction_head(iou_token_out)
+        iou_pred = self.iou_prediction_head(iou_token_out)[:, mask_slice]
+
+        # Gather the outputs back for every prompt
+        if inverse is not None:
+            masks, iou_pred = masks[inverse], iou_pred[inverse]
 
         return masks, iou_pred
 
+    # 这个 predict_masks_batched 方法在一次 transformer 调用中预测多组 prompt 的掩码。它包含:
+    # 1. 输入参数:
+    #     - image_embeddings: 单张图像的图像编码器的输出
+    #     - image_pe: 与 image_embeddings 形状相同的位置编码
+    #     - sparse_prompt_embeddings: 每组 prompt 的点和框的 embedding 列表, 点数可以不同
+    #     - dense_prompt_embeddings: 每组 prompt 的掩码输入的 embedding 列表
+    #     - multimask_output: 是否返回多个掩码或单个掩码
+    # 2. 将每组 sparse embedding 用 0 填充到相同的点数, 记录填充的位置, 并在 batch 方向拼接。
+    # 3. 通过 _run_predict_masks 调用 predict_masks, 填充的点在注意力中被屏蔽。
+    # 4. 按每组 prompt 的 batch 大小拆分 masks 和 iou_pred 并返回。
+    def predict_masks_batched(
+        self,
+        image_embeddings: torch.Tensor,
+        image_pe: torch.Tensor,
+        sparse_prompt_embeddings: List[torch.Tensor],
+        dense_prompt_embeddings: List[torch.Tensor],
+        multimask_output: bool,
+    ) -> Tuple[List[torch.Tensor], List[torch.Tensor]]:
+        """
+        Predicts masks for several prompt sets on one image with a single
+        decoder call. The sets may have different numbers of points; they are
+        padded to the same number and the padding is masked out of attention,
+        so each set gets the same masks as when decoded on its own.
+
+        Arguments:
+          image_embeddings (torch.Tensor): the embeddings from the image
+            encoder for a single image, in 1xCxHxW format
+          image_pe (torch.Tensor): positional encoding with the shape of image_embeddings
+          sparse_prompt_embeddings (list(torch.Tensor)): the embeddings of the
+            points and boxes of each prompt set, each in BxNxC format
+          dense_prompt_embeddings (list(torch.Tensor)): the embeddings of the
+            mask inputs of each prompt set, each in BxCxHxW format
+          multimask_output (bool): Whether to return multiple masks or a single
+            mask.
+
+        Returns:
+          (list(torch.Tensor)): batched predicted masks for each prompt set
+          (list(torch.Tensor)): batched predictions of mask quality for each
+            prompt set
+        """
+        assert image_embeddings.shape[0] == 1, "Batched prompt sets must share a single image."
+        max_num_points = max(sparse.shape[1] for sparse in sparse_prompt_embeddings)
+        padded_sparse, padding_masks = [], []
+        for sparse in sparse_prompt_embeddings:
+            b, n, _ = sparse.shape
+            padded_sparse.append(F.pad(sparse, (0, 0, 0, max_num_points - n)))
+            padding_mask = torch.zeros(b, max_num_points, dtype=torch.bool, device=sparse.device)
+            padding_mask[:, n:] = True
+            padding_masks.append(padding_mask)
+
+        if multimask_output:
+            mask_slice = slice(1, None)
+        else:
+            mask_slice = slice(0, 1)
+
+        masks, iou_pred = self._run_predict_masks(
+            image_embeddings=image_embeddings,
+            image_pe=image_pe,
+            sparse_prompt_embeddings=torch.cat(padded_sparse, dim=0),
+            dense_prompt_embeddings=torch.cat(dense_prompt_embeddings, dim=0),
+            mask_slice=mask_slice,
+            sparse_prompt_padding_mask=torch.cat(padding_masks, dim=0),
+        )
+
+        batch_sizes = [sparse.shape[0] for sparse in sparse_prompt_embeddings]
+        return list(masks.split(batch_sizes)), list(iou_pred.split(batch_sizes))
+
+    # _deduplicate_prompts 方法: 如果 batch 中有重复的 prompt, 返回去重后的 sparse 和 dense embedding,
+    # 以及将每个 prompt 映射回去重后的行的索引 inverse; 否则返回 None。
+    # 只有图像和 dense embedding 也相同时, 相同的 prompt 才会得到相同的掩码,
+    # 所以只在单张图像且 dense embedding 在 batch 上广播 (例如没有掩码输入) 时去重。
+    # 检查是否有重复需要一次 device 到 host 的同步, 所以默认关闭 (参数 deduplicate_prompts 默认为 False),
+    # 只应在预期会有重复 prompt 时开启。
+    def _deduplicate_prompts(
+        self,
+        image_embeddings: torch.Tensor,
+        sparse_prompt_embeddings: torch.Tensor,
+        dense_prompt_embeddings: torch.Tensor,
+    ) -> Optional[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]:
+        # Checked first so that tracing and dynamo never see the data-dependent branches
+        if torch.jit.is_tracing() or _is_compiling():
+            return None
+        b = sparse_prompt_embeddings.shape[0]
+        if (
+            b < 4
+            or image_embeddings.shape[0] != 1
+            or (dense_prompt_embeddings.shape[0] != 1 and dense_prompt_embeddings.stride(0) != 0)
+        ):
+            return None
+        flat = sparse_prompt_embeddings.reshape(b, -1)
+        # Rows with distinct sums are distinct; this avoids the full row-wise
+        # unique when there are no duplicates, but still syncs with the host
+        if torch.unique(flat.sum(-1)).shape[0] == b:
+            return None
+        unique, inverse = torch.unique(flat, dim=0, return_inverse=True)
+        n = unique.shape[0]
+        if n == b:
+            return None
+        unique = unique.view(n, *sparse_prompt_embeddings.shape[1:])
+        return unique, dense_prompt_embeddings[:n], inverse
+
+    # _load_from_state_dict 方法: 将旧 checkpoint 中分开的 iou_token 和 mask_tokens 拼接为 output_tokens。
+    def _load_from_state_dict(
+        self, state_dict: Dict[str, Any], prefix: str, *args: Any, **kwargs: Any
+    ) -> None:
+        iou_key = prefix + "iou_token.weight"
+        mask_key = prefix + "mask_tokens.weight"
+        if iou_key in state_dict and mask_key in state_dict:
+            state_dict[prefix + "output_tokens.weight"] = torch.cat(
+                [state_dict.pop(iou_key), state_dict.pop(mask_key)], dim=0
+            )
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+# torch.compile modes that capture CUDA graphs, and the same modes without them
+_NO_CUDAGRAPHS_MODE = {
+    "reduce-overhead": "default",
+    "max-autotune": "max-autotune-no-cudagraphs",
+}
+
+
+def _is_compiling() -> bool:
+    compiler = getattr(torch, "compiler", None)
+    return compiler is not None and hasattr(compiler, "is_compiling") and compiler.is_compiling()
+
+
 # 这个 MLP 类实现了多层感知机 (Multi-Layer Perceptron)。
 # Lightly adapted from
 # https://github.com/facebookresearch/MaskFormer/blob/main/mask_former/modeling/transformer/transformer_predictor.py # noqa
@@ -209,8 +525,9 @@ class MLP(nn.Module):
     #     - output_dim: 输出维度
     #     - num_layers: 隐藏层数
     #     - sigmoid_output: 是否使用 sigmoid 激活函数
+    #     - pretransposed: 是否使用预先转置权重的 _PretransposedLinear 代替 nn.Linear
     # 2. 记录 num_layers 和 h 为 num_layers-1 个隐藏层维度。
-    # 3. 实例化 nn.ModuleList 由 nn.Linear 组成的列表,用于实现 MLP 的线性变换。
+    # 3. 实例化 nn.ModuleList 由 nn.Linear (或 _PretransposedLinear) 组成的列表,用于实现 MLP 的线性变换。
     # 4. 记录 sigmoid_output 以决定是否使用 sigmoid 激活函数。
     def __init__(
         self,
@@ -219,23 +536,108 @@ class MLP(nn.Module):
         output_dim: int,
         num_layers: int,
         sigmoid_output: bool = False,
+        pretransposed: bool = False,
     ) -> None:
         super().__init__()
         self.num_layers = num_layers
         h = [hidden_dim] * (num_layers - 1)
+        linear = _PretransposedLinear if pretransposed else nn.Linear
         self.layers = nn.ModuleList(
-            nn.Linear(n, k) for n, k in zip([input_dim] + h, h + [output_dim])
+            linear(n, k) for n, k in zip([input_dim] + h, h + [output_dim])
         )
         self.sigmoid_output = sigmoid_output
 
     # forward 方法: 
-    # 1. 对输入 x 重复 num_layers 次线性变换和激活。
-    # 2. 最后一层只使用线性变换,不使用激活函数。
+    # 1. 对输入 x 重复 num_layers-1 次线性变换和激活。
+    # 2. 最后一层只使用线性变换,不使用激活函数, 在循环外单独调用, 循环内无需逐层判断。
     # 3. 如果 sigmoid_output 为 True, 使用 sigmoid 激活函数。
     # 4. 返回 MLP 的输出。
     def forward(self, x):
-        for i, layer in enumerate(self.layers):
-            x = F.relu(layer(x)) if i < self.num_layers - 1 else layer(x)
+        for i in range(self.num_layers - 1):
+            x = F.relu(self.layers[i](x))
+        x = self.layers[self.num_layers - 1](x)
         if self.sigmoid_output:
             x = F.sigmoid(x)
         return x
+
+
+# 这个 _PretransposedLinear 类实现了权重预先转置存储的线性层, 可直接调用 torch.addmm。
+class _PretransposedLinear(nn.Module):
+    """
+    A Linear layer whose weight is stored transposed, as in_features x
+    out_features, so the forward is a single addmm. Checkpoints saved with
+    nn.Linear are transposed when loaded.
+    """
+
+    def __init__(self, in_features: int, out_features: int) -> None:
+        super().__init__()
+        linear = nn.Linear(in_features, out_features)
+        self.weight_t = nn.Parameter(linear.weight.detach().t().contiguous())
+        self.bias = nn.Parameter(linear.bias.detach())
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if x.dim() == 2:
+            return torch.addmm(self.bias, x, self.weight_t)
+        return torch.matmul(x, self.weight_t) + self.bias
+
+    def _load_from_state_dict(
+        self, state_dict: Dict[str, Any], prefix: str, *args: Any, **kwargs: Any
+    ) -> None:
+        legacy_key = prefix + "weight"
+        if legacy_key in state_dict:
+            state_dict[prefix + "weight_t"] = state_dict.pop(legacy_key).t()
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+# 这个 _FusedHyperMLP 类将形状相同的多个 MLP 堆叠在一起, 每层只需一次批量矩阵乘法。
+class _FusedHyperMLP(nn.Module):
+    """
+    Evaluates several identically shaped MLPs, one per mask token, with a
+    single batched matmul per layer instead of one Linear per MLP. Weights
+    are copied out of the given MLPs and stored pretransposed, and
+    checkpoints saved with a ModuleList of MLPs are converted when loaded.
+    """
+
+    # __init__方法:
+    # 1. 输入参数 mlps: 形状相同的 MLP 列表。
+    # 2. 将每层的 weight 转置后堆叠为 (num_mlps, in, out), bias 堆叠为 (num_mlps, out)。
+    def __init__(self, mlps: List["MLP"]) -> None:
+        super().__init__()
+        self.num_mlps = len(mlps)
+        self.num_layers = mlps[0].num_layers
+        self.weights_t = nn.ParameterList(
+            nn.Parameter(torch.stack([mlp.layers[j].weight.detach().t() for mlp in mlps]))
+            for j in range(self.num_layers)
+        )
+        self.biases = nn.ParameterList(
+            nn.Parameter(torch.stack([mlp.layers[j].bias.detach() for mlp in mlps]))
+            for j in range(self.num_layers)
+        )
+
+    # forward 方法:
+    # 1. 输入 x 的形状为 B x k x C, 其中 k 个 token 对应 mlp_slice 选中的 MLP, 变换为 k x B x C。
+    # 2. 每层使用 torch.baddbmm 同时计算所有 MLP, 除最后一层外使用 relu 激活。
+    # 3. 变换回 B x num_mlps x C_out 并返回。
+    def forward(self, x: torch.Tensor, mlp_slice: slice = slice(0, None)) -> torch.Tensor:
+        x = x.transpose(0, 1)
+        for i in range(self.num_layers):
+            weight_t = self.weights_t[i][mlp_slice]
+            bias = self.biases[i][mlp_slice]
+            x = torch.baddbmm(bias.unsqueeze(1), x, weight_t)
+            if i < self.num_layers - 1:
+                x = F.relu(x)
+        return x.transpose(0, 1)
+
+    # _load_from_state_dict 方法: 将旧的 ModuleList 格式 ({i}.layers.{j}.weight) 转置并堆叠为新的格式。
+    def _load_from_state_dict(
+        self, state_dict: Dict[str, Any], prefix: str, *args: Any, **kwargs: Any
+    ) -> None:
+        for j in range(self.num_layers):
+            for name, fused_key in (("weight", f"weights_t.{j}"), ("bias", f"biases.{j}")):
+                legacy_keys = [f"{prefix}{i}.layers.{j}.{name}" for i in range(self.num_mlps)]
+                if all(k in state_dict for k in legacy_keys):
+                    fused = torch.stack([state_dict.pop(k) for k in legacy_keys])
+                    if name == "weight":
+                        fused = fused.transpose(1, 2)
+                    state_dict[prefix + fused_key] = fused
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
@@ -26,8 +26,10 @@ class Sam(nn.Module):
     #     - mask_decoder: 根据图像 embedding 和编码的提示预测掩码。
     #     - pixel_mean: 输入图像像素的归一化均值。
     #     - pixel_std: 输入图像像素的归一化标准差。
+    #     - compile_mask_decoder: 是否使用 torch.compile 编译 mask_decoder 的 predict_masks。
     # 2. 调用父类初始化。
-    # 3. 记录 image_encoder、prompt_encoder 和 mask_decoder。
+    # 3. 记录 image_encoder、prompt_encoder 和 mask_decoder,
+    #    如果 compile_mask_decoder 为 True 则编译 mask_decoder。
     # 4. 使用 register_buffer 注册 pixel_mean 和 pixel_std。
     def __init__(
         self,
@@ -36,6 +38,7 @@ class Sam(nn.Module):
         mask_decoder: MaskDecoder,
         pixel_mean: List[float] = [123.675, 116.28, 103.53],
         pixel_std: List[float] = [58.395, 57.12, 57.375],
+        compile_mask_decoder: bool = False,
     ) -> None:
         """
         SAM predicts object masks from an image and input prompts.
@@ -48,11 +51,15 @@ class Sam(nn.Module):
             and encoded prompts.
           pixel_mean (list(float)): Mean values for normalizing pixels in the input image.
           pixel_std (list(float)): Std values for normalizing pixels in the input image.
+          compile_mask_decoder (bool): Whether to compile the mask decoder's
+            predict_masks with torch.compile.
         """
         super().__init__()
         self.image_encoder = image_encoder
         self.prompt_encoder = prompt_encoder
         self.mask_decoder = mask_decoder
+        if compile_mask_decoder:
+            self.mask_decoder.compile_predict_masks()
         self.register_buffer("pixel_mean", torch.Tensor(pixel_mean).view(-1, 1, 1), False)
         self.register_buffer("pixel_std", torch.Tensor(pixel_std).view(-1, 1, 1), False)
 
@@ -8,7 +8,7 @@ import torch
 from torch import Tensor, nn
 
 import math
-from typing import Tuple, Type
+from typing import Optional, Tuple, Type
 
 from .common import MLPBlock
 
@@ -77,18 +77,24 @@ class TwoWayTransformer(nn.Module):
     #     - image_embedding: 要处理的图像,形状为 B x embedding_dim x h x w
     #     - image_pe: 与 image_embedding 形状相同的位置编码
     #     - point_embedding: 要添加到查询点的 embedding ,形状为 B x N_points x embedding_dim
+    #     - return_spatial: 是否将处理后的 image_embedding 以 B x embedding_dim x h x w 的形状返回
+    #     - point_padding_mask: 可选, 形状为 B x N_points, 为 True 的点是填充的, 不会被注意到
     # 2. 将 image_embedding 变形为 B x HW x C, image_pe 相应变形。
     # 3. 将 queries 初始化为 point_embedding, keys 初始化为 image_embedding。
+    #    如果提供了 point_padding_mask, 将其转换为加性注意力掩码, 在点作为 key 时屏蔽填充的点。
     # 4. 对 queries 和 keys 重复使用 layers 中的 TwoWayAttentionBlock。
     # 5. 应用 final_attn_token_to_image 从 points 到 image 的注意力。
     # 6. 使用 norm_final_attn 规范化 queries。
-    # 7. 返回 queries 和 keys。
+    # 7. 如果 return_spatial 为 True, 将 keys 变形回 B x C x h x w (不复制数据)。
+    # 8. 返回 queries 和 keys。
 
     def forward(
         self,
         image_embedding: Tensor,
         image_pe: Tensor,
         point_embedding: Tensor,
+        return_spatial: bool = False,
+        point_padding_mask: Optional[Tensor] = None,
     ) -> Tuple[Tensor, Tensor]:
         """
         Args:
@@ -98,6 +104,12 @@ class TwoWayTransformer(nn.Module):
             have the same shape as image_embedding.
           point_embedding (torch.Tensor): the embedding to add to the query points.
             Must have shape B x N_points x embedding_dim for any N_points.
+          return_spatial (bool): whether to return the processed image_embedding
+            in B x embedding_dim x h x w format instead of B x h*w x embedding_dim.
+          point_padding_mask (torch.Tensor or None): a boolean tensor of shape
+            B x N_points that is True for padded points. Padded points are
+            never attended to, so the outputs for the other points match
+            those computed without the padding.
 
         Returns:
           torch.Tensor: the processed point_embedding
@@ -112,6 +124,13 @@ class TwoWayTransformer(nn.Module):
         queries = point_embedding
         keys = image_embedding
 
+        # Additive mask over the points whenever they are attended to
+        point_attn_mask = None
+        if point_padding_mask is not None:
+            point_attn_mask = torch.zeros(
+                point_padding_mask.shape, dtype=point_embedding.dtype, device=point_embedding.device
+            ).masked_fill(point_padding_mask, float("-inf"))[:, None, None, :]
+
         # Apply transformer blocks and final layernorm
         for layer in self.layers:
             queries, keys = layer(
@@ -119,6 +138,7 @@ class TwoWayTransformer(nn.Module):
                 keys=keys,
                 query_pe=point_embedding,
                 key_pe=image_pe,
+                query_attn_mask=point_attn_mask,
             )
 
         # Apply the final attention layer from the points to the image
@@ -128,6 +148,10 @@ class TwoWayTransformer(nn.Module):
         queries = queries + attn_out
         queries = self.norm_final_attn(queries)
 
+        if return_spatial:
+            # A view in channels_last layout, not a copy
+            keys = keys.transpose(1, 2).view(bs, c, h, w)
+
         return queries, keys
 
 # 这个 TwoWayAttentionBlock 类实现了 transformer 块,包含四个层:
@@ -200,6 +224,7 @@ class TwoWayAttentionBlock(nn.Module):
     #     - query_pe: query 的位置编码
     #     - keys: 密集输入,即图像输入
     #     - key_pe: key 的位置编码
+    #     - query_attn_mask: 可选, 在 queries 作为 key 被注意时使用的加性注意力掩码
     # 2. 如果 skip_first_layer_pe 为 True，则 qkv 都来自 queries
     # 3. 使用 self_attn 计算 queries 的自注意力。
     # 4. 通过 norm1 规范化 queries。
@@ -211,14 +236,19 @@ class TwoWayAttentionBlock(nn.Module):
     # 10. 通过 norm4 规范化 queries。
     # 11. 返回 queries 和 keys。
     def forward(
-        self, queries: Tensor, keys: Tensor, query_pe: Tensor, key_pe: Tensor
+        self,
+        queries: Tensor,
+        keys: Tensor,
+        query_pe: Tensor,
+        key_pe: Tensor,
+        query_attn_mask: Optional[Tensor] = None,
     ) -> Tuple[Tensor, Tensor]:
         # Self attention block
         if self.skip_first_layer_pe:
-            queries = self.self_attn(q=queries, k=queries, v=queries)
+            queries = self.self_attn(q=queries, k=queries, v=queries, attn_mask=query_attn_mask)
         else:
             q = queries + query_pe
-            attn_out = self.self_attn(q=q, k=q, v=queries)
+            attn_out = self.self_attn(q=q, k=q, v=queries, attn_mask=query_attn_mask)
             queries = queries + attn_out
         queries = self.norm1(queries)
 
@@ -237,7 +267,7 @@ class TwoWayAttentionBlock(nn.Module):
         # Cross attention block, image embedding attending to tokens
         q = queries + query_pe
         k = keys + key_pe
-        attn_out = self.cross_attn_image_to_token(q=k, k=q, v=queries)
+        attn_out = self.cross_attn_image_to_token(q=k, k=q, v=queries, attn_mask=query_attn_mask)
         keys = keys + attn_out
         keys = self.norm4(keys)
 
@@ -297,12 +327,15 @@ class Attention(nn.Module):
     # forward方法:
     # 1. 对 q、k 和 v 使用 q_proj、k_proj 和 v_proj 进行投影,将 embedding_dim 映射到 internal_dim。
     # 2. 使用 _separate_heads 将 q、k 和 v 分离为 num_heads 个头。
-    # 3. 计算 attn 为 q 和 k 的点积,除以 c_per_head 开根号,再使用 softmax 归一化。
+    # 3. 计算 attn 为 q 和 k 的点积,除以 c_per_head 开根号,
+    #    加上可选的 attn_mask, 再使用 softmax 归一化。
     # 4. 使用 attn 和 v 计算 out。
     # 5. 使用 _recombine_heads 重新组合出 num_heads 个头。
     # 6. 使用 out_proj 将 out 投影回 embedding_dim。
     # 7. 返回 out。
-    def forward(self, q: Tensor, k: Tensor, v: Tensor) -> Tensor:
+    def forward(
+        self, q: Tensor, k: Tensor, v: Tensor, attn_mask: Optional[Tensor] = None
+    ) -> Tensor:
         # Input projections
         q = self.q_proj(q)
         k = self.k_proj(k)
@@ -317,6 +350,8 @@ class Attention(nn.Module):
         _, _, _, c_per_head = q.shape
         attn = q @ k.permute(0, 1, 3, 2)  # B x N_heads x N_tokens x N_tokens
         attn = attn / math.sqrt(c_per_head)
+        if attn_mask is not None:
+            attn = attn + attn_mask
         attn = torch.softmax(attn, dim=-1)
 
         # Get output
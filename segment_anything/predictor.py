@@ -87,6 +87,9 @@ class SamPredictor:
         self.input_size = tuple(transformed_image.shape[-2:])
         input_image = self.model.preprocess(transformed_image)
         self.features = self.model.image_encoder(input_image)
+        # The positional encoding does not depend on the prompts, so compute it
+        # once per image instead of on every predict call
+        self.image_pe = self.model.prompt_encoder.get_dense_pe()
         self.is_image_set = True
 
     def predict(
@@ -228,7 +231,7 @@ class SamPredictor:
         # Predict masks
         low_res_masks, iou_predictions = self.model.mask_decoder(
             image_embeddings=self.features,
-            image_pe=self.model.prompt_encoder.get_dense_pe(),
+            image_pe=self.image_pe,
             sparse_prompt_embeddings=sparse_embeddings,
             dense_prompt_embeddings=dense_embeddings,
             multimask_output=multimask_output,
@@ -263,6 +266,7 @@ class SamPredictor:
         """Resets the currently set image."""
         self.is_image_set = False
         self.features = None
+        self.image_pe = None
         self.orig_h = None
         self.orig_w = None
         self.input_h = None